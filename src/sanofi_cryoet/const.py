@@ -7,6 +7,7 @@ DB_DIR = "/root/cloud-data/its-cmo-darwin-magellan-workspaces-folders/WS_Cryoem/
 ID_DB = "/root/cloud-data/its-cmo-darwin-magellan-workspaces-folders/WS_Cryoem/CX_LMR/Project_directories/cryo-et-pipeline/ids.csv"
 PROC_DIR = 'Aligned'
 TIMEOUT = 3600  # Time until time out, in seconds
+MAX_TRANSFERS = 4  # Number of datasets transferred to the database at once
 EXT = '*_rec.mrc'  # Suffix of completed tomogram
 BIN = 6  # Bin factor
 GPU = 0  # Number GPU device - 0 for best
@@ -26,4 +27,5 @@ CONFIG_ARGS = {
     'imod_reconstruction': ['FAKE_SIRT_ITERS', 'RECONSTRUCT_METHOD', 'SIRT_ITERS', 'THICKNESS_BINNED', 'THICKNESS_UNBINNED',],
     'imod_postprocess': ['DO_TRIMVOL', 'REORIENT'],
     'denoise': ['DO_DENOISING']
-}
\ No newline at end of file
+}
+CONFIG_ARGS_SETS = {k: frozenset(v) for k, v in CONFIG_ARGS.items()}
@@ -5,14 +5,89 @@
 # This script will be passed the data processing parameters by the main shell script 
 
 from __future__ import annotations
+from collections import ChainMap
+import copy
 from dataclasses import dataclass, field
+import functools
+import os
 from pathlib import Path
 import sys
-import subprocess
-import tomllib
+from typing import Optional
+
+from .const import CONFIG_ARGS_SETS, PROC_DIR
+from .utils import chdir, get_one_mdoc, read_mdoc
+
+
+# Templates for the serieswatcher COM and ADOC files. Placeholders are keys from the config TOML
+_COM_TEMPLATE = (
+    '$batchruntomo -StandardInput\n'
+    'NamingStyle     1\n'
+    'MakeSubDirectory\n'
+    'CPUMachineList  localhost:{CPUS}\n'
+    'GPUMachineList  {GPUS}\n'
+    'NiceValue       15\n'
+    'EtomoDebug      0\n'
+    'DirectiveFile   {DIRECTIVE_FILE}\n'
+    'CurrentLocation {OUT_DIR}\n'
+    'BypassEtomo\n'
+)
+_ADOC_TEMPLATE = (
+    'setupset.systemTemplate = /usr/local/IMOD/SystemTemplate/cryoSample.adoc\n'
+    'runtime.Preprocessing.any.removeXrays = {REMOVE_XRAYS}\n'
+    'comparam.prenewst.newstack.BinByFactor = {PREALIGN_BIN}\n'
+    'runtime.Fiducials.any.trackingMethod = {TRACK_METHOD}\n'
+    'setupset.copyarg.gold = {SIZE_GOLD}\n'
+    'runtime.AlignedStack.any.binByFactor = {FINAL_BIN}\n'
+    'runtime.Reconstruction.any.useSirt = {DO_SIRT}\n'
+    'runtime.Trimvol.any.scaleFromZ = \n'
+    'runtime.Postprocess.any.doTrimvol = {DO_TRIMVOL}\n'
+    'setupset.copyarg.pixel = {PIXEL_SIZE}\n'
+    'setupset.copyarg.rotation = {TILTAXIS}\n'
+    'setupset.copyarg.dosesym = {DOSE_SYM}\n'
+    'setupset.copyarg.voltage = {VOLTAGE}\n'
+    'setupset.copyarg.Cs = {CS}\n'
+    'comparam.prenewst.newstack.AntialiasFilter = 4\n'
+    'comparam.newst.newstack.AntialiasFilter = 4\n'
+    'runtime.Trimvol.any.reorient = {REORIENT}\n'
+    'comparam.tilt.tilt.THICKNESS = {THICKNESS_UNBINNED}\n'
+)
+_ADOC_FIDUCIAL = (
+    'runtime.Fiducials.any.seedingMethod = 1\n'
+    'comparam.track.beadtrack.SobelFilterCentering = {USE_SOBEL}\n'
+    'comparam.autofidseed.autofidseed.TargetNumberOfBeads = {NUM_BEADS}\n'
+)
+_ADOC_SOBEL = 'comparam.track.beadtrack.KernelSigmaForSobel = {SOBEL_SIGMA}\n'
+_ADOC_PATCH = (
+    'comparam.xcorr_pt.tiltxcorr.SizeOfPatchesXandY = {PATCH_SIZE_X},{PATCH_SIZE_Y}\n'
+    'comparam.xcorr_pt.tiltxcorr.OverlapOfPatchesXandY = {PATCH_OVERLAP_X},{PATCH_OVERLAP_Y}\n'
+)
+_ADOC_CTF = (
+    'runtime.AlignedStack.any.correctCTF = {DO_CTF}\n'
+    'comparam.ctfplotter.ctfplotter.ScanDefocusRange = {DEFOCUS_RANGE_LOW},{DEFOCUS_RANGE_HIGH}\n'
+    'runtime.CTFplotting.any.autoFitRangeAndStep = {AUTOFIT_RANGE},{AUTOFIT_STEP}\n'
+    'comparam.ctfplotter.ctfplotter.BaselineFittingOrder = 4\n'
+    'comparam.ctfplotter.ctfplotter.SearchAstigmatism = 1\n'
+)
+_ADOC_FAKE_SIRT = 'comparam.tilt.tilt.FakeSIRTiterations = {FAKE_SIRT_ITERS}'
+
+
+def _load_toml(path: str | Path) -> dict:
+    """ Load a TOML file, preferring the Rust-backed rtoml parser if it is installed """
+    try:
+        import rtoml
+    except ImportError:
+        import tomllib
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path, "r", encoding="utf-8") as f:
+        return rtoml.load(f)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_toml_cached(path: str, mtime_ns: int) -> dict:
+    """ Parsed TOML for a config file version; the dict is shared between calls, so callers must deepcopy it """
+    return _load_toml(path)
 
-from .const import CONFIG_ARGS, PROC_DIR
-from .utils import chdir, get_one_mdoc, read_mdoc, typewriter
 
 @dataclass
 class Config:
@@ -39,8 +114,9 @@ class Config:
     
     @classmethod
     def from_toml(cls, toml: Path) -> Config:
-        with open(toml, "rb") as f:
-            data = tomllib.load(f)
+        # Each Config gets its own copy of the cached TOML, since the pipeline edits config values in place
+        path = os.path.realpath(toml)
+        data = copy.deepcopy(_load_toml_cached(path, os.stat(path).st_mtime_ns))
         status = cls._validate(data)
         if status[0] != 0:
             raise ValueError(f"Invalid entries in the config TOML. The following entries must be specified: {status[1]}")
@@ -60,19 +136,11 @@ class Config:
         -------
         tuple[int, str]: error code (0 if ok, 1 if error) and list of values causing the error
         """
-        errors = []
-        for val in CONFIG_ARGS['setup']:
-            if val not in data['setup']:
-                errors.append(val)
-        
-        for val in CONFIG_ARGS['setup_data']:
-            if val not in data['setup']['data']:
-                errors.append(val)
+        errors = sorted(CONFIG_ARGS_SETS['setup'] - data['setup'].keys())
+        errors.extend(sorted(CONFIG_ARGS_SETS['setup_data'] - data['setup']['data'].keys()))
 
         if data['setup']['data']['READ_MDOC'] == 0:
-            for val in CONFIG_ARGS['data']:
-                if val not in data['data']:
-                    errors.append(val)
+            errors.extend(sorted(CONFIG_ARGS_SETS['data'] - data['data'].keys()))
 
         if len(errors) > 0:
             return 1, errors
@@ -89,12 +157,15 @@ class ConfigDirs:
     THUMB_DIR: Path
 
 
-def setup_serieswatcher(config: Config) -> tuple[Path, Path]:
+def setup_serieswatcher(config: Config, coms_dir: Optional[Path]=None) -> tuple[Path, Path]:
     """
     Construct the COM and ADOC files to to run serieswatcher
 
     :param: config
         Config containing tipeline arguments passed from the config TOML
+    :param: coms_dir
+        Directory to write the COM and ADOC files to, defaults to ./coms.
+        serieswatcher needs real files, so pass a tmpfs path (e.g. /dev/shm/coms) to keep them off disk
 
     :return: tuple of files
         master com file, master adoc file
@@ -102,92 +173,57 @@ def setup_serieswatcher(config: Config) -> tuple[Path, Path]:
     # Get those parameters which can be read from the mdoc - pixel size, exposure, tilt angles
     mdoc_info = read_mdoc(get_one_mdoc(config.dirs.OUT_DIR))
 
-    master_com = Path.cwd() / Path('coms/BRT_MASTER.com')
-    master_com.parent.mkdir(parents=True, exist_ok=True)
-    master_adoc = Path.cwd() / Path('coms/BRT_MASTER.adoc')
-    master_adoc.parent.mkdir(parents=True, exist_ok=True)
+    if coms_dir is None:
+        coms_dir = Path.cwd() / 'coms'
+    coms_dir.mkdir(parents=True, exist_ok=True)
+    master_com = coms_dir / 'BRT_MASTER.com'
+    master_adoc = coms_dir / 'BRT_MASTER.adoc'
+
+    # Unpack the nested config tables once
+    imod = config.imod
+    tracking = imod['tracking']
+    fiducial = tracking.get('fiducial', {})
+    patch = tracking.get('patch', {})
+    recon = imod['reconstruction']
+    fa = imod['final_alignment']
+    ctf = imod['ctf']
+    post = imod['postprocess']
+    dw = imod['dose_weight']
 
     if not config.data['PIXEL_SIZE']:
         config.data['PIXEL_SIZE'] == mdoc_info['Pixel Size']
-    if config.imod['reconstruction']['THICKNESS_BINNED']:
-        config.imod['reconstruction']['THICKNESS_UNBINNED'] = config.imod['reconstruction']['THICKNESS_BINNED'] * config.imod['final_alignment']['FINAL_BIN']
-    do_sirt = 1 if config.imod['RECONSTRUCT_METHOD'] == 2 else 0
-
-    # Construct the com file
-    master_com.write_text(
-        '$batchruntomo -StandardInput\n'
-        'NamingStyle     1\n'
-        'MakeSubDirectory\n'
-        f'CPUMachineList  localhost:{config.setup["CPUS"]}\n'
-        f'GPUMachineList  {config.setup["GPUS"]}\n'
-        'NiceValue       15\n'
-        'EtomoDebug      0\n'
-        f'DirectiveFile   {master_adoc}\n'
-        f'CurrentLocation {config.dirs.OUT_DIR}\n'
-        'BypassEtomo\n'
-    )
-    
-    # Construct the adoc file
-    master_adoc.write_text(
-        'setupset.systemTemplate = /usr/local/IMOD/SystemTemplate/cryoSample.adoc\n'
-        f'runtime.Preprocessing.any.removeXrays = {config.imod['REMOVE_XRAYS']}\n'
-        f'comparam.prenewst.newstack.BinByFactor = {config.imod['PREALIGN_BIN']}\n'
-        f'runtime.Fiducials.any.trackingMethod = {config.imod['tracking']['TRACK_METHOD']}\n'
-        f'setupset.copyarg.gold = {config.imod['tracking']['SIZE_GOLD']}\n'
-        f'runtime.AlignedStack.any.binByFactor = {config.imod['final_alignment']['FINAL_BIN']}\n'
-        f'runtime.Reconstruction.any.useSirt = {do_sirt}\n'
-        'runtime.Trimvol.any.scaleFromZ = \n'
-        f'runtime.Postprocess.any.doTrimvol = {config.imod['postprocess']['DO_TRIMVOL']}\n'
-        f'setupset.copyarg.pixel = {config.data['PIXEL_SIZE']}\n'
-        f'setupset.copyarg.rotation = {config.setup['TILTAXIS']}\n'
-        f'setupset.copyarg.dosesym = {config.imod['dose_weight']['DOSE_SYM']}\n'
-        f'setupset.copyarg.voltage = {config.imod['ctf']['VOLTAGE']}\n'
-        f'setupset.copyarg.Cs = {config.imod['ctf']['CS']}\n'
-        'comparam.prenewst.newstack.AntialiasFilter = 4\n'
-        'comparam.newst.newstack.AntialiasFilter = 4\n'
-        f'runtime.Trimvol.any.reorient = {config.imod['postprocess']['REORIENT']}\n'
-        f'comparam.tilt.tilt.THICKNESS = {config.imod['reconstruction']['THICKNESS_UNBINNED']}\n'
+    if recon['THICKNESS_BINNED']:
+        recon['THICKNESS_UNBINNED'] = recon['THICKNESS_BINNED'] * fa['FINAL_BIN']
+    do_sirt = 1 if recon['RECONSTRUCT_METHOD'] == 2 else 0
+
+    # Fill the templates from the config tables. Placeholders are the TOML keys
+    params = ChainMap(
+        {'DO_SIRT': do_sirt, 'DIRECTIVE_FILE': master_adoc, 'OUT_DIR': config.dirs.OUT_DIR},
+        config.setup, config.data, imod, tracking, fa, ctf, dw, recon, post,
     )
+    master_com.write_bytes(_COM_TEMPLATE.format_map(params).encode())
+
+    # Construct the adoc file in memory, then write it out once
+    adoc_lines = [_ADOC_TEMPLATE.format_map(params)]
 
-    if config.imod['tracking']['TRACK_METHOD'] == 0:
+    if tracking['TRACK_METHOD'] == 0:
         # Fiducial tracking
-        with master_adoc.open("a") as f:
-            f.write(
-                'runtime.Fiducials.any.seedingMethod = 1\n'
-                f'comparam.track.beadtrack.SobelFilterCentering = {config.imod['tracking']['fiducial']['USE_SOBEL']}\n'
-                f'comparam.autofidseed.autofidseed.TargetNumberOfBeads = {config.imod['tracking']['fiducial']['NUM_BEADS']}\n'
-            )
-        
-        if int(config.imod['tracking']['fiducial']['USE_SOBEL']) == 1:
-            with master_adoc.open("a") as f:
-                f.write(
-                    f'comparam.track.beadtrack.KernelSigmaForSobel = {config.imod['tracking']['fiducial']['SOBEL_SIGMA']}\n'
-                )
-    elif config.imod['tracking']['TRACK_METHOD'] == 1:
+        adoc_lines.append(_ADOC_FIDUCIAL.format_map(fiducial))
+        if int(fiducial['USE_SOBEL']) == 1:
+            adoc_lines.append(_ADOC_SOBEL.format_map(fiducial))
+    elif tracking['TRACK_METHOD'] == 1:
         # Patch tracking
-        with master_adoc.open("a") as f:
-            f.write(
-                f'comparam.xcorr_pt.tiltxcorr.SizeOfPatchesXandY = {config.imod['tracking']['patch']['PATCH_SIZE_X']},{config.imod['tracking']['patch']['PATCH_SIZE_Y']}\n'
-                f'comparam.xcorr_pt.tiltxcorr.OverlapOfPatchesXandY = {config.imod['tracking']['patch']['PATCH_OVERLAP_X']},{config.imod['tracking']['patch']['PATCH_OVERLAP_Y']}\n'
-            )
+        adoc_lines.append(_ADOC_PATCH.format_map(patch))
     else:
-        raise ValueError(f"Tracking method of {config.imod['tracking']['TRACK_METHOD']} is not supported")
+        raise ValueError(f"Tracking method of {tracking['TRACK_METHOD']} is not supported")
     
-    if config.imod['final_alignment']['DO_CTF'] == 1:
-        with master_adoc.open("a") as f:
-            f.write(
-                f'runtime.AlignedStack.any.correctCTF = {config.imod['final_alignment']['DO_CTF']}\n'
-                f'comparam.ctfplotter.ctfplotter.ScanDefocusRange = {config.imod['ctf']['DEFOCUS_RANGE_LOW']},{config.imod['ctf']['DEFOCUS_RANGE_HIGH']}\n'
-                f'runtime.CTFplotting.any.autoFitRangeAndStep = {config.imod['ctf']['AUTOFIT_RANGE']},{config.imod['ctf']['AUTOFIT_STEP']}\n'
-                'comparam.ctfplotter.ctfplotter.BaselineFittingOrder = 4\n'
-                'comparam.ctfplotter.ctfplotter.SearchAstigmatism = 1\n'
-            )
+    if fa['DO_CTF'] == 1:
+        adoc_lines.append(_ADOC_CTF.format_map(params))
 
     if do_sirt == 0:
-        with master_adoc.open("a") as f:
-            f.write(
-                f'comparam.tilt.tilt.FakeSIRTiterations = {config.imod['reconstruction']['FAKE_SIRT_ITERS']}'
-            )
+        adoc_lines.append(_ADOC_FAKE_SIRT.format_map(recon))
+
+    master_adoc.write_bytes("".join(adoc_lines).encode())
             
     return master_com, master_adoc
 
@@ -202,6 +238,8 @@ def setup_framewatcher(config: Config) -> tuple[Path]:
     
 
 if __name__ == '__main__':
+    import subprocess
+
     if len(sys.argv) < 34:
         raise ValueError("Not enough arguments passed to DB_RECONSTRUCT")
 
@@ -237,7 +275,6 @@ if __name__ == '__main__':
         'tune_fitting_sample': sys.argv[32],
         'fake_sirt_iters': sys.argv[33]
     }
-    assert 'out_dir' in pipeline_args
     pipeline_args['out_dir'] = Path.cwd() / Path(pipeline_args['out_dir'])
 
     print(pipeline_args)
@@ -249,8 +286,7 @@ if __name__ == '__main__':
         # subprocess.run(cmd, shell=True)
 
         # cmd = f'tmux send-keys "serieswatcher -com {com} -adoc {adoc}" C-m'
-        cmd = f'serieswatcher -com {com} -adoc {adoc}'
-        subprocess.run(cmd, shell=True)
+        subprocess.run(['serieswatcher', '-com', str(com), '-adoc', str(adoc)], check=False)
         
         print(f"CHECK STATUS OF PIPELINE RECONSTRUCTION WITH COMMAND: tmux a -t {brt_pipeline}")
         print("DETACH SESSION (i.e. still running, but now longer watching it) with: control-b d")
@@ -4,17 +4,25 @@
 # Transfer actively processing data to the database and a centralized location for all cryo-ET data at Sonofi US
 # This script will be passed the data processing directory by the main script 
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fnmatch import fnmatch
+import glob
 import logging
 import os
 from pathlib import Path
+import re
+import shutil
 import sys
 import subprocess
+import threading
 import time
-from typing import Optional
+from typing import Generator, Optional
 
 import polars as pl
 
-from .const import ID_DB, DB_DIR, TIMEOUT
+from .const import ID_DB, DB_DIR, MAX_TRANSFERS, TIMEOUT
+from .utils import watch_dir
 
 logging.basicConfig(
     level=logging.INFO,
@@ -30,8 +38,44 @@ formatter = logging.Formatter(
 )
 
 
+# Frame file named on a SubFramePath line, stripped of its (Windows) directory
+_SUBFRAME_RE = re.compile(rb'^[ \t]*SubFramePath[ \t]*=[ \t]*(?:[^\r\n]*\\)?([^\\\r\n]+?)[ \t]*\r?$', re.MULTILINE)
+
+# Status markers written by batchruntomo into the swbrt logs
+_LOG_MARKERS = (b'ERROR', b'ABORT', b'SUCCESSFULLY COMPLETED')
+
+
+def _count_markers(data: bytes, start: int=0, end: Optional[int]=None) -> Counter:
+    """ Count each status marker in data[start:end] """
+    # The markers cannot overlap each other, so bytes.count (C substring search) matches the regex counts
+    if end is None:
+        end = len(data)
+    return Counter({m: data.count(m, start, end) for m in _LOG_MARKERS})
+
+# Processing files left out of the database copy of a dataset, as rsync arguments
+_EXCLUDES = ('*~', '*.log*', '*.adoc', 'dfltcoms', 'origcoms', '*_preali.mrc', '*_full_rec.mrc', '*.out')
+_EXCLUDE_ARGS = tuple(f"--exclude={e}" for e in _EXCLUDES)
+
+
+def _iter_subframes(mdoc: str | Path) -> Generator[tuple[str, str], None, None]:
+    """ Yield (filename, extension) for every subframe file listed in an mdoc """
+    with open(mdoc, 'rb') as f:
+        data = f.read()
+    for m in _SUBFRAME_RE.finditer(data):
+        file = m.group(1).decode()
+        yield file, file.rpartition('.')[2]
+
+
+def _has_match(path: str, pattern: str) -> bool:
+    """ Check whether a directory directly contains a file matching the glob pattern """
+    with os.scandir(path) as it:
+        return any(fnmatch(e.name, pattern) for e in it)
+
+
 class CryoETDB:
 
+    _id_dbs: dict[str, tuple[int, pl.DataFrame]] = {}  # ID CSV path -> (mtime, parsed IDs)
+
     def __init__(self, id: int, filename: str, db_dir: str | Path) -> None:
         self.id: int = id
         self.id_database: str = filename
@@ -44,7 +88,11 @@ class CryoETDB:
             self.db_dir: Path = db_dir
         self.completed: dict[Optional[str], Optional[str]] = {}
         self.not_processed: Optional[list[str]] = []
+        self._log_state: dict[str, tuple[int, int, int, int]] = {}  # log -> (bytes scanned, errors, aborts, successes)
         self.logger = logging.getLogger(__name__)
+        self._handlers: dict[tuple[str, str], logging.Handler] = {}  # (logger name, log file) -> handler
+        self._handlers_lock = threading.Lock()  # set_logger is called from the transfer threads
+        self._last_sig: Optional[tuple] = None  # Signature of proc_dir at the last initialize_datasets
 
     
     def __repr__(self) -> str:
@@ -53,13 +101,31 @@ class CryoETDB:
 
     def parse_ids(self) -> None:
         """ Get the Database IDs for each user. """
-        self.all_ids: pl.DataFrame = pl.read_csv(self.id_database, truncate_ragged_lines=True)
+        self.all_ids: pl.DataFrame = CryoETDB._load_id_db(self.id_database)
+
+
+    @classmethod
+    def _load_id_db(cls, path: str | Path) -> pl.DataFrame:
+        """ Read the ID CSV, shared between instances until the file is modified """
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        cached = cls._id_dbs.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = cls._id_dbs[path] = (
+                mtime,
+                pl.scan_csv(path, truncate_ragged_lines=True)
+                .select(["id", "name"])
+                .collect()
+            )
+        return cached[1]
 
     
     def get_user(self) -> str:
         """ Get the user based on the databse ID """
-        return [row["name"] for row in self.all_ids.iter_rows(named=True)
-                if row["id"] == self.id][0]
+        names = self.all_ids.filter(pl.col("id") == self.id).get_column("name")
+        if names.is_empty():
+            raise ValueError(f"No user with database ID {self.id} in {self.id_database}")
+        return names.item(0)
     
 
     def get_initials(self) -> str:
@@ -69,26 +135,42 @@ class CryoETDB:
 
     def get_procdirs(self, proc_dir: str | Path) -> list[Path]:
         """ Get processing directories to incorporate into the database """
-        return [x for x in proc_dir.iterdir() if x.is_dir and list(x.glob(EXT))]
-    
-
-    def get_mdocs(self, dirs: list[Path]) -> list[Path]:
-        """ Get mdoc files for each processing directory """
-        return [x for d in dirs for x in list(d.glob('*.mdoc'))]
+        with os.scandir(proc_dir) as it:
+            return [Path(e.path) for e in it if e.is_dir() and _has_match(e.path, EXT)]
     
 
-    def get_mdoc_dates(self, mdocs: list[Path]) -> list[str]:
-        """ Get dataset dates from the mdocs, based on the Jensen Lab / Chang Lab pipelines """
-        return [time.strftime('%Y-%m-%d', time.gmtime(os.path.getmtime(m))) for m in mdocs]
+    def _walk_mdocs(self, dirs: list[Path]) -> Generator[tuple[str, float], None, None]:
+        """ Yield (path, mtime) of the mdoc files in each processing directory """
+        for d in dirs:
+            with os.scandir(d) as it:
+                for e in it:
+                    if e.name.endswith('.mdoc'):
+                        yield e.path, e.stat().st_mtime
     
 
-    def search_db_identicals(self, entry_ids: list[str]) -> list[int]:
+    def search_db_identicals(self, entry_ids: list[str]) -> dict[str, int]:
         """ Search database for given initial/date ID, return number currently existing """
-        # Initially do this without SQL -> Just scan the database directory for matching IDs
-        return {
-            e: len(list(self.db_dir.glob(f'{e}*'))) 
-            for e in entry_ids
-        }
+        # Same prefix counting as initialize_datasets, via count_db_entries (once per ID length)
+        # Counts are kept per length, so a short ID is never looked up in a longer ID's counts
+        counts: dict[int, dict[str, int]] = {}
+        for n in {len(e) for e in entry_ids}:
+            df = self.count_db_entries(prefix_len=n).collect()
+            counts[n] = dict(zip(df["base"], df["existing"]))
+        return {e: counts[len(e)].get(e, 0) for e in entry_ids}
+
+
+    def count_db_entries(self, prefix_len: int) -> pl.LazyFrame:
+        """ Count database entries by the first prefix_len characters of their name (i.e. the initial/date ID) """
+        try:
+            with os.scandir(self.db_dir) as it:
+                names = [e.name for e in it]
+        except FileNotFoundError:
+            names = []
+        return (
+            pl.LazyFrame({"name": names}, schema={"name": pl.Utf8})
+            .group_by(pl.col("name").str.slice(0, prefix_len).alias("base"))
+            .agg(pl.len().cast(pl.Int64).alias("existing"))
+        )
 
 
     def set_logger(
@@ -98,21 +180,40 @@ class CryoETDB:
             level: int=logging.INFO, 
             head: bool=False
     ) -> Optional[logging.Logger]:
-        """ Set the log handler to log to the appropriate file """
+        """
+        Set the log handler to log to the appropriate file
+        Handlers are cached per (logger, file), so repeated calls reuse the existing handler
+        and a logger moved to a new file drops the handler for its previous one
+        """
         assert filename[-4:] == '.log'
 
-        if not Path(filename).exists():
+        logger = self.logger if head is True else logging.getLogger(name)
+        logger.setLevel(level)
+        key = (logger.name, os.path.abspath(filename))
+        with self._handlers_lock:
+            if key in self._handlers:
+                return logger
+
+            self._drop_handlers(logger)
             handler = logging.FileHandler(filename)
             handler.setFormatter(formatter)
-            if head is True:
-                self.logger.setLevel(level)
-                self.logger.addHandler(handler)
-            else:
-                logger = logging.getLogger(name)
-                logger.setLevel(level)
-                logger.addHandler(handler)
+            logger.addHandler(handler)
+            self._handlers[key] = handler
+        return logger
 
-                return logger
+
+    def close_logger(self, logger: logging.Logger) -> None:
+        """ Close and remove the file handlers set_logger added to the logger """
+        with self._handlers_lock:
+            self._drop_handlers(logger)
+
+
+    def _drop_handlers(self, logger: logging.Logger) -> None:
+        """ Close and forget the cached handlers of the logger; the caller holds self._handlers_lock """
+        for key in [k for k in self._handlers if k[0] == logger.name]:
+            handler = self._handlers.pop(key)
+            logger.removeHandler(handler)
+            handler.close()
 
 
     def initialize_datasets(self, proc_dir: str | Path) -> pl.DataFrame:
@@ -124,36 +225,71 @@ class CryoETDB:
         
         if not self.logger.handlers:
             filename = f'{time.strftime("%Y%m%d_%H%M", time.localtime())}_TRANSFERS.log'
-            self.set_logger(f'{Path.cwd() / proc_dir}/{filename}', head=True)
+            self.set_logger(f'{os.path.abspath(proc_dir)}/{filename}', head=True)
+
+        # Skip the rescan if no processing directory (or the database) has changed since the last call
+        sig = self._dir_signature(proc_dir)
+        if sig == self._last_sig:
+            return self.df
 
         # Get processing directories and mdocs
         dirs: list[Path] = self.get_procdirs(proc_dir=proc_dir)
-        mdocs: list[Path] = self.get_mdocs(dirs=dirs)
+        # Sorted by dataset name (then mdoc), so entry ID suffixes follow the dataset order, not scandir order
+        mdocs: list[tuple[str, float]] = sorted(
+            self._walk_mdocs(dirs=dirs),
+            key=lambda m: (os.path.basename(os.path.dirname(m[0])), os.path.basename(m[0]))
+        )
 
         # Get dataset names, mdoc names, and dates to assemble into DataFrame
-        dates: list[str] = self.get_mdoc_dates(mdocs)
-        dataset_names: list[str] = [d.name.split('/')[-1] for d in dirs]
-        mdoc_names: list[str] = [m.name.split('/')[-1] for m in mdocs]
+        # Dataset dates come from the mdocs, based on the Jensen Lab / Chang Lab pipelines
+        dates: list[str] = [time.strftime('%Y-%m-%d', time.gmtime(mtime)) for _, mtime in mdocs]
+        dataset_names: list[str] = [os.path.basename(os.path.dirname(m)) for m, _ in mdocs]
+        mdoc_names: list[str] = [os.path.basename(m) for m, _ in mdocs]
 
-        # Get current Database entries for these initials and year
+        # Get current Database entries for these initials and date, then number each new
+        # entry after those already in the database, counting per initial/date ID
         all_entry_ids = [f"{self.initials}{date}" for date in dates]
-        unique_entry_ids = list(set(all_entry_ids))
-        num_entries: dict[str, int] = self.search_db_identicals(entry_ids=unique_entry_ids)
-
-        for entry_id in num_entries:
-            for i, e in enumerate(all_entry_ids, num_entries[entry_id]):
-                all_entry_ids[i-num_entries[entry_id]] = f"{e}-{i+1}" 
+        existing = self.count_db_entries(prefix_len=len(self.initials) + len("YYYY-MM-DD"))
+        all_entry_ids = (
+            pl.LazyFrame({"base": all_entry_ids}, schema={"base": pl.Utf8})
+            .join(existing, on="base", how="left", maintain_order="left")
+            .select(
+                (
+                    pl.col("base") + "-"
+                    + (pl.col("existing").fill_null(0) + pl.int_range(pl.len()).over("base") + 1).cast(pl.Utf8)
+                ).alias("id")
+            )
+            .collect()
+            .get_column("id")
+            .to_list()
+        )
 
         assert len(dates) == len(dataset_names) == len(mdoc_names) == len(all_entry_ids)
 
         self.logger.info('%d processing datasets' % len(dataset_names))
 
-        self.df: pl.DataFrame = pl.LazyFrame({
-            "id": all_entry_ids,
-            "dataset": sorted(dataset_names),
-            "mdoc": sorted(mdoc_names),
-            "date": dates
-        }).collect()  # Returns a DataFrame
+        self.df: pl.DataFrame = pl.DataFrame(
+            {
+                "id": all_entry_ids,
+                "dataset": dataset_names,
+                "mdoc": mdoc_names,
+                "date": dates
+            },
+            schema={"id": pl.Utf8, "dataset": pl.Utf8, "mdoc": pl.Utf8, "date": pl.Utf8}
+        )
+        self._last_sig = sig  # Only once self.df is rebuilt, so a failed rescan is retried next call
+        return self.df
+
+
+    def _dir_signature(self, proc_dir: Path) -> tuple:
+        """ Cheap change detector: mtimes of proc_dir, its subdirectories, and the database directory """
+        with os.scandir(proc_dir) as it:
+            children = sorted((e.name, e.stat().st_mtime_ns) for e in it if e.is_dir())
+        try:
+            db_mtime = os.stat(self.db_dir).st_mtime_ns
+        except FileNotFoundError:
+            db_mtime = None
+        return (os.stat(proc_dir).st_mtime_ns, tuple(children), db_mtime)
 
 
     def transfer(self, proc_dir: str | Path, subframe_path: Optional[str | Path]=None) -> int:
@@ -168,145 +304,179 @@ class CryoETDB:
         if not proc_dir.exists():
             raise ValueError(f"Processing directory {proc_dir} does not exist")
 
+        proc_dir_str = os.path.abspath(proc_dir)
         done_dir = proc_dir / 'Done'
-        cmd = f"mkdir -p {done_dir}"
-        subprocess.run(cmd, shell=True)
+        done_dir.mkdir(parents=True, exist_ok=True)
+
+        if isinstance(subframe_path, str):
+            subframe_path = Path(subframe_path)
 
         print(self.df)
         
-        # Iterate over each completed dataset, first transferring the frames and
+        # Transfer completed datasets concurrently, first transferring the frames and
         # processed data to the database location, then moving to the 'Done' subdir
-        for dataset in sorted(self.completed):
-            print(f"DATASET: {dataset}")
-            try:
-                row = self.df.row(
-                    by_predicate=(pl.col('dataset') == dataset),
-                    named=True
-                )
-                print(row)
-            except pl.exceptions.NoRowsReturnedError:
-                self.not_processed.append(dataset)
-                continue
+        completed = sorted(self.completed)
+        rows = (
+            self.df.filter(pl.col('dataset').is_in(completed))
+            .rows_by_key('dataset', named=True, include_key=True, unique=True)
+        )
+        self.not_processed.extend(dataset for dataset in completed if dataset not in rows)
 
-            self.dataset_logger = self.set_logger(
-                filename=f'{Path.cwd() / proc_dir}/{time.strftime("%Y%m%d_%H%M", time.localtime())}_{row["dataset"]}-{row["id"]}_transfer.log',
-                name=f'{row["id"]}',
-            )
-            
+        exit_code = 0
+        with ThreadPoolExecutor(max_workers=MAX_TRANSFERS) as pool:
+            futures = [
+                pool.submit(self._transfer_one, rows[dataset], proc_dir_str, done_dir, subframe_path)
+                for dataset in completed if dataset in rows
+            ]
+            for future in as_completed(futures):
+                exit_code = max(exit_code, future.result())
+        return exit_code
+
+
+    def _transfer_one(
+            self,
+            row: dict[str, str],
+            proc_dir: str,
+            done_dir: Path,
+            subframe_path: Optional[Path]=None
+    ) -> int:
+        """
+        Transfer one completed dataset (and its frames) to the database, then move it to done_dir
+        row is the dataset's row of self.df; proc_dir is the absolute processing directory, as a string
+
+        :return: int (0 for success, 1 for error)
+        """
+        print(f"DATASET: {row['dataset']}")
+        print(row)
+
+        status = 0
+        db_dir = os.fspath(self.db_dir)
+        dataset_logger = self.set_logger(
+            filename=f'{proc_dir}/{time.strftime("%Y%m%d_%H%M", time.localtime())}_{row["dataset"]}-{row["id"]}_transfer.log',
+            name=f'{row["id"]}',
+        )
+
+        # Close the dataset's log file when done, so each transferred dataset does not keep a file open
+        try:
+            proc_frames = None
             if DOSE_FRACTIONS:  # equals 1
                 if subframe_path:
-                    if isinstance(subframe_path, str):
-                        subframe_path = Path(subframe_path)
-                    
                     # Fetch the mdoc and construct the transfer command
-                    mdoc = proc_dir / Path(f"{row['dataset']}/{row['mdoc']}")
-                    transfer_path_frames = Path(f"{self.db_dir}/{row['id']}/Frames")
-                    cmd = f"mkdir -p {transfer_path_frames}" # Here, the mdoc is already in the processing directory for this dataset. May need to change this
+                    mdoc = f"{proc_dir}/{row['dataset']}/{row['mdoc']}"
+                    transfer_path_frames = f"{db_dir}/{row['id']}/Frames"  # Here, the mdoc is already in the processing directory for this dataset. May need to change this
 
-                    # Transfer the raw frames first for this dataset
-                    cmd_frames = self._transfer_rawframes(
+                    # Transfer the raw frames first for this dataset, with one rsync reading the file list from stdin
+                    frames = self._transfer_rawframes(
                         subframe_path=subframe_path, 
                         transfer_path=transfer_path_frames,
                         mdoc=mdoc,
-                        cmd=cmd
+                        logger=dataset_logger
                     )
-                    self.dataset_logger.info('TRANSFERRING FRAMES FOR %s -> %s' % (row['dataset'], row['id']))
-                    print(f"TRANSFERRING FRAMES FOR {row['dataset']} -> {row['id']}")
-                    proc_frames = subprocess.Popen(cmd_frames, shell=True)
+                    if frames is not None:
+                        dataset_logger.info('TRANSFERRING FRAMES FOR %s -> %s' % (row['dataset'], row['id']))
+                        print(f"TRANSFERRING FRAMES FOR {row['dataset']} -> {row['id']}")
+                        proc_frames = subprocess.Popen(
+                            ["rsync", "--ignore-existing", "-a", "--files-from=-", f"{subframe_path}/", transfer_path_frames],
+                            stdin=subprocess.PIPE,
+                            text=True
+                        )
+                        try:
+                            proc_frames.stdin.write("".join(f"{frame}\n" for frame in frames))
+                            proc_frames.stdin.close()
+                        except OSError as e:  # BrokenPipeError if rsync exits before reading the list; still reaped below
+                            status = 1
+                            dataset_logger.error('ERROR sending the frame list to rsync for %s' % row['id'])
+                            dataset_logger.error('ERROR %s' % e)
+                    else:
+                        status = 1
                 else:
-                    self.dataset_logger.warning('NO SUBFRAME PATH. FRAMES WILL NOT BE TRANSFERRED TO THE DATABASE')
+                    dataset_logger.warning('NO SUBFRAME PATH. FRAMES WILL NOT BE TRANSFERRED TO THE DATABASE')
 
             # Transfer the dataset
-            transfer_path_set = Path(f"{self.db_dir}/{row['id']}")
-            dataset_dir = proc_dir / Path(f"{row['dataset']}")
+            transfer_path_set = f"{db_dir}/{row['id']}"
+            dataset_dir = Path(f"{proc_dir}/{row['dataset']}")
             cmd_dataset = self._transfer_dataset(
                 transfer_path=transfer_path_set,
                 dataset_dir=dataset_dir
             )
-            self.dataset_logger.info('TRANSFERRING DATASET FOR %s -> %s' % (row['dataset'], row['id']))
-            proc_dataset = subprocess.Popen(cmd_dataset, shell=True)
+            dataset_logger.info('TRANSFERRING DATASET FOR %s -> %s' % (row['dataset'], row['id']))
+            proc_dataset = subprocess.Popen(cmd_dataset)
 
-            # Wait for transferring of frames and dataset to complete before going to next dataset
-            if DOSE_FRACTIONS and subframe_path:
+            # Wait for transferring of frames and dataset to complete before moving the dataset
+            if proc_frames is not None:
                 proc_frames.communicate()
                 if (exit_code := proc_frames.returncode) != 0:
-                    self.dataset_logger.error('ERROR transferring frames for %s' % row['id'])
-                    self.dataset_logger.error('ERROR CODE %d' % exit_code)
+                    status = 1
+                    dataset_logger.error('ERROR transferring frames for %s' % row['id'])
+                    dataset_logger.error('ERROR CODE %d' % exit_code)
 
             proc_dataset.communicate()
             if (exit_code := proc_dataset.returncode) != 0:
-                self.dataset_logger.error('ERROR transferring processed data for %s' % row['id'])
-                self.dataset_logger.error('ERROR CODE %d' % exit_code)
-            
-            swbrt_log = f"{proc_dir}/swbrt_{row['dataset']}*.log"
-            cmd = f"mv {dataset_dir} {swbrt_log} {done_dir}"
-            self.dataset_logger.info('MOVING DATASET %s TO %s' % (row['dataset'], done_dir))
-            if (exit_code := subprocess.run(cmd, shell=True).returncode) != 0:
-                self.dataset_logger.error('ERROR moving dataset %s to %s' % (row['dataset'], done_dir))
-                self.dataset_logger.error('ERROR CODE %d' % exit_code)
+                status = 1
+                dataset_logger.error('ERROR transferring processed data for %s' % row['id'])
+                dataset_logger.error('ERROR CODE %d' % exit_code)
+
+            swbrt_logs = glob.glob(f"{proc_dir}/swbrt_{glob.escape(row['dataset'])}*.log")
+            dataset_logger.info('MOVING DATASET %s TO %s' % (row['dataset'], done_dir))
+            try:
+                for path in [dataset_dir, *swbrt_logs]:
+                    shutil.move(path, done_dir)
+            except OSError as e:
+                status = 1
+                dataset_logger.error('ERROR moving dataset %s to %s' % (row['dataset'], done_dir))
+                dataset_logger.error('ERROR %s' % e)
+            return status
+        finally:
+            self.close_logger(dataset_logger)
 
     
     def _transfer_rawframes(
             self,
             subframe_path: Path,
-            transfer_path: Path,
-            mdoc: Path,
-            cmd: str
-    ) -> str:
+            transfer_path: str | Path,
+            mdoc: str | Path,
+            logger: logging.Logger
+    ) -> Optional[list[str]]:
         """
         Get the raw frames from the mdocs and transfer them to a rawframes subdirectory 
-        :return: str - command for transferring a dataset's raw frames
+        :return: list[str] - frames (and TIFF mdocs) to transfer, relative to subframe_path. None on error
         """
         if not subframe_path.exists():
             raise ValueError(f"Subframe directory {subframe_path} does not exist")
 
-        if (exit_code := subprocess.run(cmd, shell=True).returncode) != 0:
-            self.dataset_logger.error('ERROR creating frames directory %s/Frames in the database' % transfer_path)
-            self.dataset_logger.error('Error code %d' % exit_code)
-            return exit_code  
+        try:
+            os.makedirs(transfer_path, exist_ok=True)
+        except OSError as e:
+            logger.error('ERROR creating frames directory %s/Frames in the database' % transfer_path)
+            logger.error('Error %s' % e)
+            return None
 
         # Get frames from mdoc
-        with open(mdoc, 'r') as f:
-            files = []
-            tiffmdocs = []
-            for line in f:
-                if 'SubFramePath' in line:
-                    strip_line = line.rstrip()
-                    file = strip_line.split('\\')[-1]
-                    ext = file.split('.')[-1]
-                    if ext == 'mrc':
-                        mrcfile = f"{subframe_path}/{file}"
-                        cmd = f"rsync -a --ignore-existing {mrcfile} {transfer_path}"
-
-                        files.append(mrcfile)
-                    elif ext in ['tiff', 'tif']:
-                        tiff = f"{subframe_path}/{file}"
-                        tiff_mdoc = f"{file}.mdoc"
-
-                        try:
-                            with open(tiff_mdoc, 'r') as f:
-                                cmd = f"rsync --ignore-existing -a {tiff} {tiff_mdoc} {transfer_path}"
-                                tiffmdocs.append(tiff_mdoc)
-                        except FileNotFoundError:
-                                pass
-                        finally:
-                            files.append(tiff)
-                    else:
-                        self.dataset_logger.error('ERROR: Do not recognize frames file extenstion .%s' % ext)
-                        return 1
-                    
-            if not tiffmdocs:
-                self.dataset_logger.warning('No TIFF mdocs found in %s. If there is just one mdoc for the tilt series, no need to worry' % subframe_path)
+        files = []
+        tiffmdocs = []
+        for file, ext in _iter_subframes(mdoc):
+            if ext == 'mrc':
+                files.append(file)
+            elif ext in ['tiff', 'tif']:
+                tiff_mdoc = f"{file}.mdoc"
+                if os.path.isfile(f"{subframe_path}/{tiff_mdoc}"):
+                    tiffmdocs.append(tiff_mdoc)
+                files.append(file)
+            else:
+                logger.error('ERROR: Do not recognize frames file extenstion .%s' % ext)
+                return None
                     
-            cmd = f"rsync --ignore-existing -a {' '.join(file for file in files)} {' '.join(file for file in tiffmdocs)} {transfer_path}"
-            return cmd
+        if not tiffmdocs:
+            logger.warning('No TIFF mdocs found in %s. If there is just one mdoc for the tilt series, no need to worry' % subframe_path)
+                
+        return files + tiffmdocs
 
 
     def _transfer_dataset(
             self,
-            transfer_path: Path,
+            transfer_path: str | Path,
             dataset_dir: Path
-    ) -> str:
+    ) -> list[str]:
         """
         Transfer dataset with key files to the database directory
         Files to exclude:
@@ -320,21 +490,22 @@ class CryoETDB:
             *_preali.mrc
             *_full_rec.mrc
 
-        :return: str - command for transferring processing dataset
+        :return: list[str] - rsync arguments for transferring processing dataset
         """
         if not dataset_dir.exists():
             raise ValueError(f"Dataset directory {dataset_dir} does not exist")
         
         # Special case: Check for two *_ali.mrc files, because alignframes adds _ali.mrc onto motion corrected dataset
         # If there are 2 -> get *_ali_ali.mrc
-        ali_files: list[str] = list(dataset_dir.glob('*_ali.mrc'))
-        ali: str = max(ali_files).name if len(ali_files) > 1 else ""
+        with os.scandir(dataset_dir) as it:
+            ali_files: list[str] = [e.name for e in it if e.name.endswith('_ali.mrc') and e.is_file()]
+        ali: str = next((f for f in ali_files if f.endswith('_ali_ali.mrc')), "") if len(ali_files) > 1 else ""
         
-        if ali  == "":
-            cmd = f"rsync --ignore-existing -a --exclude={{'*~','*.log*','*.adoc','dfltcoms','origcoms','*_preali.mrc','*_full_rec.mrc','*.out'}} {dataset_dir}/ {transfer_path}"
-        else:
-            cmd = f"rsync --ignore-existing -a --exclude={{'*~','*.log*','*.adoc','dfltcoms','origcoms','{ali}','*_preali.mrc','*_full_rec.mrc','*.out'}} {dataset_dir}/ {transfer_path}"
-        return cmd
+        return [
+            "rsync", "--ignore-existing", "-a", *_EXCLUDE_ARGS,
+            *([f"--exclude={ali}"] if ali else []),
+            f"{dataset_dir}/", str(transfer_path)
+        ]
     
 
     def watch_for_completion(self, proc_dir: str | Path) -> int:
@@ -363,34 +534,48 @@ class CryoETDB:
         # Open each log, check for competion, add to self.completed if dataset is completed
         completed_success = 0
         completed_error = 0
+        log_state, self._log_state = self._log_state, {}  # Drop logs that have since been moved to 'Done'
         for logfile in sw_logs:
             # Keep track of number of ERROR, ABORT, and SUCCESSFULLY COMPLETED
-            num_error, num_abort, num_success = 0, 0, 0
-            with open(logfile, 'r') as f:
-                for line in f:
-                    strip_line = line.rstrip()
-                    if "ERROR" in strip_line:
-                        num_error += 1
-                    if "ABORT" in strip_line:
-                        num_abort += 1
-                    if "SUCCESSFULLY COMPLETED" in strip_line:
-                        num_success += 1
-                
-                # Determine if processing is ongoing, terminated early, or successfully completed
-                # 0 for success, -1 for error, 1 for ongoing
-                status: int = (
-                    -1 if num_abort > 1 or num_error > 0 
-                    else 0 if num_success == 1 
-                    else 1 
-                )
-                
-                if status < 1:
-                    basename = f.name.split('swbrt_')[-1].split('.')[0]
-                    self.completed[basename] = 'completed' if status == 0 else 'error'
-                    if self.completed[basename] == 'completed':
-                        completed_success += 1
-                    elif self.completed[basename] == 'error':
-                        completed_error += 1
+            # Only scan what was appended since the last poll. Counts from a trailing
+            # partial line are used for this poll but not saved, so it is rescanned once complete
+            key = os.fspath(logfile)
+            offset, num_error, num_abort, num_success = log_state.get(key, (0, 0, 0, 0))
+            size = os.stat(key).st_size
+            if size < offset:  # Log was rewritten, start over
+                offset, num_error, num_abort, num_success = 0, 0, 0, 0
+            partial = Counter()
+            if size > offset:
+                with open(key, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(size - offset)
+                end = data.rfind(b'\n') + 1
+                counts = _count_markers(data, 0, end)
+                partial = _count_markers(data, end)
+                offset += end
+                num_error += counts[b'ERROR']
+                num_abort += counts[b'ABORT']
+                num_success += counts[b'SUCCESSFULLY COMPLETED']
+            self._log_state[key] = (offset, num_error, num_abort, num_success)
+            
+            # Determine if processing is ongoing, terminated early, or successfully completed
+            # 0 for success, -1 for error, 1 for ongoing
+            num_error += partial[b'ERROR']
+            num_abort += partial[b'ABORT']
+            num_success += partial[b'SUCCESSFULLY COMPLETED']
+            status: int = (
+                -1 if num_abort > 1 or num_error > 0 
+                else 0 if num_success == 1 
+                else 1 
+            )
+            
+            if status < 1:
+                basename = logfile.name.split('swbrt_')[-1].split('.')[0]
+                self.completed[basename] = 'completed' if status == 0 else 'error'
+                if self.completed[basename] == 'completed':
+                    completed_success += 1
+                elif self.completed[basename] == 'error':
+                    completed_error += 1
         self.logger.info(
             '%d processing directories: %d completed SUCCESSFULLY, %d completed with ERROR, %d ONGOING' % (
                 len(sw_logs), 
@@ -419,29 +604,46 @@ if __name__ == '__main__':
 
     db = CryoETDB(id=ID, filename=ID_DB, db_dir=DB_DIR)
 
-    start = time.time()
-    while True:
-        db.initialize_datasets(PROC_DIR)
-        new_procs: int = db.watch_for_completion(PROC_DIR)
+    # Wake up as soon as a log or mdoc changes, instead of only polling every 60 s
+    wake = threading.Event()
+    observer = watch_dir(PROC_DIR, ["*swbrt*.log", "*.mdoc"], lambda _: wake.set())
 
-        print(f'NEW PROCS: {new_procs}')
+    # Stop the watcher thread however the loop ends
+    try:
+        start = time.time()
+        while True:
+            db.initialize_datasets(PROC_DIR)
+            new_procs: int = db.watch_for_completion(PROC_DIR)
 
-        if new_procs:
-            db.transfer(PROC_DIR, SUBFRAME_PATH)
-            start = time.time()  # Reset the timer
+            print(f'NEW PROCS: {new_procs}')
 
-        end = time.time()
-        if (end - start) > TIMEOUT:
-            fw_pipeline = 'fw_pipeline'
-            brt_pipeline = 'brt_pipeline'
-            transfer_pipeline = 'db_pipeline'
+            if new_procs:
+                db.transfer(PROC_DIR, SUBFRAME_PATH)
+                start = time.time()  # Reset the timer
+
+            end = time.time()
+            if (end - start) > TIMEOUT:
+                fw_pipeline = 'fw_pipeline'
+                brt_pipeline = 'brt_pipeline'
+                transfer_pipeline = 'db_pipeline'
             
-            cmd = f'tmux kill-session -t {fw_pipeline}'  # Recontruction and transfer being run in a tmux session
-            subprocess.run(cmd, shell=True)
-            cmd = f'tmux kill-session -t {brt_pipeline}'
-            subprocess.run(cmd, shell=True)
-            cmd = f'tmux kill-session -t {transfer_pipeline}'
-            subprocess.run(cmd, shell=True)
-
-            break
-        time.sleep(60)
+                # Recontruction and transfer being run in a tmux session
+                for session in (fw_pipeline, brt_pipeline, transfer_pipeline):
+                    subprocess.run(['tmux', 'kill-session', '-t', session])
+
+                break
+
+            if observer is None:
+                time.sleep(60)
+                continue
+            # Debounce: after a change, wait until the directory has been quiet for 5 s before the next pass
+            # Logs are appended to for the whole reconstruction, so still pass at least every 60 s as before
+            deadline = time.monotonic() + 60
+            if wake.wait(timeout=60):
+                wake.clear()
+                while (remaining := deadline - time.monotonic()) > 0 and wake.wait(timeout=min(5, remaining)):
+                    wake.clear()
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
@@ -4,12 +4,15 @@
 # Entry point into the cryo-ET data processing pipeline
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
 import os
 from pathlib import Path
+import re
 import subprocess
 import sys
+import tempfile
 import time
 from typing import Optional
 
@@ -37,9 +40,20 @@ formatter = logging.Formatter(
 )
 logger = logging.getLogger(__name__)
 
+# Pipeline config TOML, set with the CRYOET_CONFIG environment variable or the config.toml shipped with the package
+_CONF_PATH: Path = Path(os.environ.get("CRYOET_CONFIG", Path(__file__).parent / "config.toml")).resolve()
+
+# Tilt axis value in an mdoc, with the key kept in group 1
+_TILT_RE = re.compile(rb'(TiltAxisAngle[ \t]*=[ \t]*)-?[0-9]+\.[0-9]+')
+
+# (minimum CPUS, parallel downloads) for pipe storage cp, checked in order; fewer than 4 CPUs uses pipe's default
+_PIPE_THREADS = ((8, 4), (4, 2))
+
+# Threads for the file renames/moves in pipeline_setup, which wait on the filesystem rather than the CPU
+_IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
 def main():
-    conf_toml: Path = Path('/Users/U1036725/Documents/Projects/Cryo-ET_Setup/Pipeline_PyProject/sanofi-cryoet/src/sanofi_cryoet/config.toml')
-    config: Config = Config.from_toml(conf_toml)
+    config: Config = Config.from_toml(_CONF_PATH)
     # pipeline_setup(config)
 
     logger.info("MAIN - Beginning serieswatcher to watch for datasets and reconstruct tomograms\n")
@@ -51,7 +65,8 @@ def main():
     # setup_tmux(fw_tmux)
 
     # TODO - START FROM HERE TO BEGIN FRAMEWATCHER AND SERIESWATCHER
-    setup_serieswatcher(config)
+    com, adoc = setup_serieswatcher(config, coms_dir=_coms_dir())
+    logger.info("MAIN - Serieswatcher COM: %s, ADOC: %s", com, adoc)
 
     # db = CryoETDB(config.setup['USER_DB_ID'], ID_DB, DB_DIR)
     
@@ -79,6 +94,13 @@ def main():
     #     time.sleep(60)
 
 
+def _coms_dir() -> Optional[Path]:
+    """ New directory on tmpfs for the serieswatcher COM/ADOC, or None (./coms) where /dev/shm does not exist """
+    if not os.path.isdir('/dev/shm'):
+        return None
+    return Path(tempfile.mkdtemp(dir='/dev/shm', prefix='cryoet-coms-'))  # Unique per run, so concurrent runs do not overwrite each other
+
+
 def pipeline_setup(conf: Config) -> None:
     """ Initialize and setup the pipeline """
     conf.dirs.SUBFRAME_DIR.mkdir(parents=True, exist_ok=True)
@@ -96,55 +118,98 @@ def pipeline_setup(conf: Config) -> None:
         if conf.setup['SOFTWARE'] == 1:
             typewriter(["===== Data collected with serialEM ====="])
         else:
+            tiltaxis = -90 - conf.setup['TILTAXIS']
             typewriter([
                 "===== Data collected with Thermo Scientific Tomography 5 =====",
                 f" -> New tilt axis is {tiltaxis}",
                 "===== Renaming the mdocs with the extension .mrc.mdoc =====",
                 "===== Adjusting the tilt axis in the mdoc ====="
             ], delay=0.02)
-            mdocs = [f for f in conf.dirs.DATA_DIR.rglob('*.mdoc')]
-            tiltaxis = -90 - conf.setup['TILTAXIS']
+            mdocs, frames = _classify(conf.dirs.DATA_DIR, conf.setup['data']['FRAMES_NAME'])
 
             # Set the new tilt axis in ths config file
             conf.setup['TILTAXIS'] = tiltaxis
 
             # Remove duplicates and rename the mdoc files with proper file extension
-            for mdoc in mdocs.copy():
-                if conf.setup['data']['MDOC_DUPLICATE'] in mdoc.name:
-                    mdoc.unlink()
-                    mdocs.remove(mdoc)
-                else:
-                    mdoc.rename(mdoc.with_suffix('.mdoc.mrc'))
-
-                    # Use shell command to change the tiltaxis in the mdoc file -- too lazy to figure this out with Python right now -- TODO
-                    cmd = fr'sed -i -E "/TiltAxisAngle *= */s/-?[0-9]+\.[0-9]+/{tiltaxis}/" {mdoc.as_posix()}'
-                    _call(cmd)
+            # Each phase is file metadata I/O, so run it across threads and wait before the next
+            duplicate = conf.setup['data']['MDOC_DUPLICATE']
+            dups = [m for m in mdocs if duplicate in os.path.basename(m)]
+            keep = [m for m in mdocs if duplicate not in os.path.basename(m)]
+            with ThreadPoolExecutor(max_workers=_IO_WORKERS) as pool:
+                list(pool.map(os.unlink, dups))
+                list(pool.map(lambda m: _rename_mdoc(m, tiltaxis), keep))
             
-            # Copy all the frames to a subdirectory called "Frames"
-            typewriter(["Moving frames to subdirectory..."], delay=0.02)
-            for frame in conf.dirs.DATA_DIR.glob(f"*{conf.setup['data']['FRAMES_NAME']}*"):
-                frame.rename(conf.dirs.SUBFRAME_DIR / frame.name)
+                # Copy all the frames to a subdirectory called "Frames"
+                # Frame-named mdocs move too, under their new name (deleted duplicates are skipped)
+                typewriter(["Moving frames to subdirectory..."], delay=0.02)
+                subframe_dir = os.fspath(conf.dirs.SUBFRAME_DIR)
+                dup_set = set(dups)
+                frames = [_renamed_mdoc(f) if f.endswith('.mdoc') else f for f in frames if f not in dup_set]
+                list(pool.map(
+                    lambda f: os.rename(f, os.path.join(subframe_dir, os.path.basename(f))),
+                    frames
+                ))
+
+
+def _classify(root: str | Path, frames_name: str) -> tuple[list[str], list[str]]:
+    """
+    Walk the data directory once and sort its files into mdocs and frames
+
+    :return: (mdocs anywhere under root, files at the top level of root matching frames_name, mdocs included)
+    """
+    root = os.fspath(root)
+    mdocs, frames = [], []
+    for dirpath, _, filenames in os.walk(root):
+        top = dirpath == root
+        for fn in filenames:
+            if fn.endswith('.mdoc'):
+                mdocs.append(os.path.join(dirpath, fn))
+            if top and frames_name in fn:
+                frames.append(os.path.join(dirpath, fn))
+    return mdocs, frames
+
+
+def _renamed_mdoc(mdoc: str) -> str:
+    """ Name of the mdoc with the proper file extension """
+    return f"{mdoc.removesuffix('.mdoc')}.mdoc.mrc"
+
+
+def _rename_mdoc(mdoc: str, tiltaxis: float) -> None:
+    """ Rename the mdoc with the proper file extension and set its tilt axis """
+    renamed = _renamed_mdoc(mdoc)
+    os.rename(mdoc, renamed)
+    _set_tiltaxis(Path(renamed), tiltaxis)
+
+
+def _set_tiltaxis(mdoc: Path, tiltaxis: float) -> None:
+    """ Set every TiltAxisAngle in the mdoc to the new tilt axis, rewriting the file only if it changed """
+    data = mdoc.read_bytes()
+    new = _TILT_RE.sub(lambda m: m.group(1) + str(tiltaxis).encode(), data)
+    if new != data:
+        mdoc.write_bytes(new)
 
 
 def _transfer_raw_data(conf: Config) -> None:
     """ Transfer raw data from microscope to local directory """
     if conf.setup['PIPE_CLI'] == 1:
-        n = (2 if 4 <= conf.setup['CPUS'] < 8 
-                else 4 if conf.setup['CPUS'] >= 8
-                else 0)
+        n = next((n for cpus, n in _PIPE_THREADS if conf.setup['CPUS'] >= cpus), 0)
         magellan_dir = f"cp://its{'/'.join(conf.setup['data']['RAW_DATA_DIR'].split('its')[1:])}"
-        cmd = (f"pipe storage cp -r --force --skip-existing -n {n} {magellan_dir} {conf.dirs.DATA_DIR}" if n > 0
-                else f"pipe storage cp -r --force --skip-existing {magellan_dir} {conf.dirs.DATA_DIR}")
+        cmd = (
+            ["pipe", "storage", "cp", "-r", "--force", "--skip-existing"]
+            + (["-n", str(n)] if n > 0 else [])
+            + [magellan_dir, str(conf.dirs.DATA_DIR)]
+        )
     else:
-        cmd = f"rsync --progress --ignore-existing -avr {conf.setup['data']['RAW_DATA_DIR']}/ {conf.dirs.DATA_DIR}"
+        # Overall progress instead of a line per file, and whole-file copies (no delta checksums) into the new directory
+        cmd = ["rsync", "--info=progress2", "--ignore-existing", "-aW", f"{conf.setup['data']['RAW_DATA_DIR']}/", str(conf.dirs.DATA_DIR)]
 
     if (exit := _call(cmd)) != 0:
         logger.warning("FAILED TO TRANSFER RAW DATA. EXIT CODE %d", exit)
 
 
-def _call(cmd: str, shell=True, *args, **kwargs) -> int:
-    """ Call an external command to run with subprocess.run """
-    exit = subprocess.run(cmd, shell=shell).returncode
+def _call(argv: list[str], **kwargs) -> int:
+    """ Call an external command to run with subprocess.run, without a shell """
+    exit = subprocess.run(argv, shell=False, check=False, **kwargs).returncode
     return exit
 
 
@@ -168,7 +233,7 @@ def setup_tmux(name: str) -> None:
         typewriter(["Tmux not installed"])
         typewriter(["-- Installing Tmux now..."])
         
-        cmd = "sudo apt install tmux"
+        cmd = ["sudo", "apt", "install", "tmux"]
         if (exit := _call(cmd)) != 0:
             raise Exception("Unable to successfully install tmux. Install tmux before running again.")
         
@@ -185,7 +250,21 @@ def setup_tmux(name: str) -> None:
 
 def kill_tmux(sessions: list[str], logger: Optional[logging.Logger]=None) -> None:
     """ Kill specified tmux sessions """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    # Kill every session with one tmux call: kill-session -t a ; kill-session -t b ...
+    # tmux stops at the first session it cannot kill, so on failure go through them one at a time
+    cmd = ["tmux"]
     for session in sessions:
-        cmd = f'tmux kill-session -t {session}'
-        if _call(cmd) != 0:
-            logger.warning("FAILED TO KILL TMUX SESSION %s. EXIT CODE %d")
\ No newline at end of file
+        cmd += ["kill-session", "-t", session, ";"]
+    if not sessions or _call(cmd[:-1]) == 0:
+        return
+
+    # Sessions before the failing one are already gone, so only retry those that still exist
+    for session in sessions:
+        if _call(["tmux", "has-session", "-t", session], stderr=subprocess.DEVNULL) != 0:
+            continue
+        cmd = ["tmux", "kill-session", "-t", session]
+        if (exit := _call(cmd)) != 0:
+            logger.warning("FAILED TO KILL TMUX SESSION %s. EXIT CODE %d", session, exit)
\ No newline at end of file
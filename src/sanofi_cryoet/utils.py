@@ -3,12 +3,45 @@
 # 
 # Helper functions
 
+from array import array
 import contextlib
+import functools
+import mmap
 import os
 from pathlib import Path
+import queue
+import re
 import sys
 import time
-from typing import Generator
+from typing import Any, Callable, Generator, Optional
+
+
+def watch_dir(path: str | Path, patterns: list[str], callback: Callable[[str], None]) -> Optional[Any]:
+    """
+    Call callback(file) whenever a file matching one of the glob patterns is created, modified, or moved into place under path
+
+    :return: the started watchdog observer (call .stop() when done), or None if watchdog is not installed
+    """
+    try:
+        from watchdog.events import PatternMatchingEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        return None
+
+    class _Handler(PatternMatchingEventHandler):
+        def on_created(self, event):
+            callback(event.src_path)
+
+        def on_modified(self, event):
+            callback(event.src_path)
+
+        def on_moved(self, event):
+            callback(event.dest_path)  # e.g. rsync renaming its temporary file into place
+
+    observer = Observer()
+    observer.schedule(_Handler(patterns=patterns, ignore_directories=True), str(path), recursive=True)
+    observer.start()
+    return observer
 
 
 @contextlib.contextmanager
@@ -23,31 +56,89 @@ def chdir(path: str | Path) -> Generator[None, None, None]:
 
          
 def typewriter(strings: list[str], delay=0.02) -> None:
+    """ Print the strings with a typewriter animation, or all at once if stdout is not a terminal or delay <= 0 """
+    if not sys.stdout.isatty() or delay <= 0:
+        sys.stdout.write("\n".join(strings) + "\n")
+        return
+
+    # Build each frame (cursor up to overwrite, then progressively longer substrings) as one write
+    n = len(strings)
+    up = "\033[F" * n
     max_length = max(len(s) for s in strings)
+    encoding = sys.stdout.encoding or 'utf-8'
+    frames = [
+        (up + "".join(s[:i + 1] + "\n" for s in strings)).encode(encoding)
+        for i in range(max_length)
+    ]
 
     # Print empty lines for each string (to reserve space)
-    for _ in strings:
-        sys.stdout.write("\n")
-    
-    for i in range(max_length):
-        sys.stdout.write("\033[F" * len(strings))  # Move cursor up to overwrite
+    sys.stdout.write("\n" * n)
+    sys.stdout.flush()
 
-        for s in strings:
-            sys.stdout.write(s[:i + 1] + "\n")  # Print progressively longer substring
-        
-        sys.stdout.flush()
+    fd = sys.stdout.fileno()
+    for frame in frames:
+        os.write(fd, frame)
         time.sleep(delay)
 
 
+# Lines of the mdoc keys read_mdoc uses, as (key, value)
+_MDOC_LINE_RE = re.compile(rb'^[ \t]*(TiltAngle|Defocus|Magnification|PixelSpacing)[ \t]*=([^\r\n]*)', re.MULTILINE)
+
+# mdoc key -> (read_mdoc field, conversion of the value, whether the key repeats per tilt)
+_MDOC_FIELDS: dict[str, tuple[str, Callable[[str], Any], bool]] = {
+    'TiltAngle': ('Tilt Angles', lambda v: round(float(v)), True),
+    'Defocus': ('Defocus', float, True),
+    'Magnification': ('Magnification', str, False),
+    'PixelSpacing': ('Pixel Size', lambda v: str(round(float(v), 2)/10), False),
+}
+
 
-def get_one_mdoc(p: Path) -> Path:
+def get_one_mdoc(p: Path, settle: float = 5) -> Path:
     """ Get mdoc files for each processing directory """
-    while True: 
-        mdocs = [x for x in list(p.rglob('*.mdoc'))]
-        if mdocs:
-            break
-        time.sleep(60)
-    return mdocs[0]
+    # Wait on filesystem events for the first mdoc if watchdog is installed, otherwise poll every minute
+    # The watcher starts before the first scan so an mdoc written in between is not missed
+    # Events are only a hint to rescan: SerialEM creates the mdoc before writing to it, so an mdoc is
+    # returned once it parses, or once its size has not changed for `settle` seconds
+    events: queue.Queue[str] = queue.Queue()
+    observer = watch_dir(p, ['*.mdoc'], events.put) if p.is_dir() else None
+    sizes: dict[Path, tuple[int, float]] = {}  # mdoc -> (size, when that size was first seen)
+    try:
+        while True:
+            now = time.monotonic()
+            for mdoc in p.rglob('*.mdoc'):
+                if _mdoc_parses(mdoc):
+                    return mdoc
+                try:
+                    size = mdoc.stat().st_size
+                except OSError:
+                    continue  # Removed since the scan
+                seen = sizes.get(mdoc)
+                if seen is None or seen[0] != size:
+                    sizes[mdoc] = (size, now)
+                elif size and now - seen[1] >= settle:
+                    return mdoc
+            # Come back within the settle interval while an mdoc is still being written
+            timeout = settle if sizes else 60
+            if observer is None:
+                time.sleep(timeout)
+                continue
+            try:
+                events.get(timeout=timeout)
+            except queue.Empty:
+                pass  # Rescan in case an event was missed
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+
+def _mdoc_parses(mdoc: Path) -> bool:
+    """ Return True if the mdoc has tilt angles and defocus values read_mdoc can use """
+    try:
+        read_mdoc(mdoc)
+    except (OSError, ValueError, ZeroDivisionError):
+        return False
+    return True
 
 
 def read_mdoc(mdoc: Path) -> dict[str, any]:
@@ -59,49 +150,47 @@ def read_mdoc(mdoc: Path) -> dict[str, any]:
     mdoc_dict = {
         "mag": [int] mag,
         "pixel size": [float] pixSize,
-        "defocus": [list[float]] defocus,
+        "defocus": [array('d')] defocus,
         "defocus avg": [float] avg_defocus,
-        "tilt angles": [list[float]] [tilt angles],
+        "tilt angles": [array('i')] [tilt angles],
         "tilt min": [float] tilt_min,
         "tilt max": [float] tilt_max
         "tilt increment": [int] tilt increment
     }
     """
-    if not mdoc.exists():
-        raise FileNotFoundError
+    # Parsed results are cached by path, mtime, and size, so an unchanged mdoc is only parsed once
+    # Arrays are copied on return so callers cannot modify the cached values
+    st = os.stat(mdoc)  # Raises FileNotFoundError for a missing mdoc
+    header_info = _read_mdoc_cached(os.fspath(mdoc), st.st_mtime_ns, st.st_size)
+    return {k: v[:] if isinstance(v, array) else v for k, v in header_info.items()}
 
+
+@functools.lru_cache(maxsize=4096)
+def _read_mdoc_cached(mdoc: str, mtime_ns: int, size: int) -> dict[str, Any]:
+    """ Parse the mdoc for read_mdoc; mtime_ns is only part of the cache key """
     # TODO - get tilt axis from the mdoc
 
-    header_info = {}
-    # Open each file and extract the relevant information
-    with open(mdoc, 'r') as f:
-        header_info['Tilt Angles'] = []
-        header_info['Defocus'] = []
-        for line in f:
-            strip_line = line.rstrip()
-            if 'TiltAngle' in strip_line:
-                index = strip_line.find('=')
-                angle = round(float(strip_line[index+2:]))
-                header_info['Tilt Angles'].append(angle)
-            if 'Defocus' in strip_line and 'Target' not in strip_line:
-                index = strip_line.find('=')
-                header_info['Defocus'].append(float(strip_line[index+2:]))
-            if 'Magnification' in strip_line:
-                index = strip_line.find('=')
-                header_info['Magnification'] = strip_line[index+2:]
-            if 'PixelSpacing' in strip_line:
-                index = strip_line.find('=')
-                header_info['Pixel Size'] = str(round(float(strip_line[index+2:]),2)/10)
-
-    header_info['Tilt Min'] = min(header_info['Tilt Angles'])
-    header_info['Tilt Max'] = max(header_info['Tilt Angles'])
+    # Find only the wanted key lines with one regex pass over the mapped file, and dispatch on the key
+    # Per-tilt values go in typed arrays: compact, and usable as buffers (e.g. np.frombuffer) downstream
+    header_info = {'Tilt Angles': array('i'), 'Defocus': array('d')}
+    with open(mdoc, 'rb') as f, (
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else contextlib.nullcontext(b'')  # Empty files cannot be mapped
+    ) as buf:
+        for m in _MDOC_LINE_RE.finditer(buf):
+            name, convert, many = _MDOC_FIELDS[m.group(1).decode()]
+            val = m.group(2).decode().strip()
+            if many:
+                header_info[name].append(convert(val))
+            else:
+                header_info[name] = convert(val)
+
+    tilts = header_info['Tilt Angles']
+    defocus = header_info['Defocus']
+    header_info['Tilt Min'] = min(tilts)
+    header_info['Tilt Max'] = max(tilts)
     header_info['Tilt Step'] = round(abs(
-        (header_info['Tilt Max'] - header_info['Tilt Min'])
-        / len(header_info['Tilt Angles'])
-    )) 
-    header_info['Defocus Avg'] = round(
-        sum(header_info['Defocus']) / float(
-            len(header_info['Defocus'])
-        ), 2)
+        (header_info['Tilt Max'] - header_info['Tilt Min']) / len(tilts)
+    ))
+    header_info['Defocus Avg'] = round(sum(defocus) / len(defocus), 2)
     
     return header_info
\ No newline at end of file